@@ -0,0 +1,276 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from scipy.sparse import csr_matrix
+
+
+def least_squares_cg_block(Cui, X, Y, YtY, cg_steps=3):
+    
+    '''
+    Function for updating a block of factors X with conjugate gradient (in place),
+    the same algorithm as implicit.als (least_squares_cg), vectorized over rows of the block.
+    
+    Cui : scipy.sparse.csr_matrix, confidences of the block rows (rows of block x columns of Y).
+    
+    X : np.ndarray, factors of the block rows, updated in place.
+    
+    Y : np.ndarray, fixed factors of the columns.
+    
+    YtY : np.ndarray, Gram matrix Y.T @ Y + regularization * I.
+    
+    cg_steps : int, number of conjugate gradient steps.
+    '''
+    
+    rows = np.repeat(np.arange(Cui.shape[0]), np.diff(Cui.indptr))
+    cols = Cui.indices
+    confidence = Cui.data.astype(X.dtype)
+    Y_nnz = Y[cols]
+    
+    # Невязка: r = Y.T Cu p - (YtY + Y.T (Cu - I) Y) x.
+    Yx = np.einsum('nf,nf->n', Y_nnz, X[rows])
+    weights = csr_matrix((confidence - (confidence - 1) * Yx, cols, Cui.indptr), shape=Cui.shape)
+    r = weights @ Y - X @ YtY
+    
+    p = r.copy()
+    rs_old = np.einsum('uf,uf->u', r, r)
+    
+    for _ in range(cg_steps):
+        Yp = np.einsum('nf,nf->n', Y_nnz, p[rows])
+        weights = csr_matrix(((confidence - 1) * Yp, cols, Cui.indptr), shape=Cui.shape)
+        Ap = p @ YtY + weights @ Y
+        
+        pAp = np.einsum('uf,uf->u', p, Ap)
+        active = (rs_old > 1e-20) & (pAp != 0)
+        alpha = np.where(active, rs_old / np.where(active, pAp, 1), 0).astype(X.dtype)
+        
+        X += alpha[:, None] * p
+        r -= alpha[:, None] * Ap
+        
+        rs_new = np.einsum('uf,uf->u', r, r)
+        beta = np.where(active, rs_new / np.where(active, rs_old, 1), 0).astype(X.dtype)
+        p = r + beta[:, None] * p
+        rs_old = rs_new
+
+
+def block_loss(Cui, X, Y, YtY):
+    
+    '''
+    Function for calculating unnormalized weighted squared error of a block of rows (without regularization):
+    sum over all (u, i) of c_ui * (p_ui - x_u y_i) ^ 2, where c_ui = 1 and p_ui = 0 outside of Cui nonzeros.
+    '''
+    
+    rows = np.repeat(np.arange(Cui.shape[0]), np.diff(Cui.indptr))
+    confidence = Cui.data.astype(np.float64)
+    Yx = np.einsum('nf,nf->n', Y[Cui.indices], X[rows]).astype(np.float64)
+    
+    loss = np.einsum('uf,fg,ug->', X, YtY, X, dtype=np.float64)
+    loss += ((confidence - 1) * Yx ** 2 - 2 * confidence * Yx + confidence).sum()
+    
+    return loss
+
+
+class ConjugateGradientALS:
+    
+    '''
+    Implicit feedback Alternating Least Squares with conjugate gradient solver (NumPy implementation).
+    
+    Works directly on scipy.sparse CSR matrices, stores factors in float32,
+    updates factors by blocks of rows in thread pool (NumPy releases GIL in matrix operations).
+    Interface is the same as implicit.als.AlternatingLeastSquares (fit on Item-User matrix,
+    recommend, similar_users, similar_items), so it can replace implicit in MainRecommender.
+    
+    Parameters
+    ----------
+    factors = 100 : int, number of latent factors.
+    
+    regularization = 0.01 : float, regularization of factors.
+    
+    iterations = 15 : int, number of ALS iterations.
+    
+    cg_steps = 3 : int, number of conjugate gradient steps per factors update.
+    
+    calculate_training_loss = False : bool, calculate loss on every iteration (kept in 'loss_history').
+    
+    random_state = None : int, seed of factors' initialization.
+    
+    block_size = 4096 : int, number of rows in one block of factors update.
+    
+    num_threads = None : int, number of threads, if None - number of processors.
+    
+    dtype = np.float32 : type of factors.
+    
+    use_gpu = False : bool, accepted for compatibility with implicit.als, GPU is not supported.
+    
+    
+    Examples
+    --------
+    >>> model = ConjugateGradientALS(factors=10, regularization=0.1, iterations=15, random_state=0)
+    >>> model.fit(csr_matrix(user_item_matrix).T.tocsr())
+    >>> model.recommend(userid=0, user_items=sparse_user_item, N=5)
+    '''
+    
+    def __init__(self, factors=100, regularization=0.01, iterations=15, cg_steps=3, calculate_training_loss=False,
+                 random_state=None, block_size=4096, num_threads=None, dtype=np.float32, use_gpu=False):
+        
+        assert not use_gpu, 'ConjugateGradientALS does not support GPU!'
+        
+        self.factors = factors
+        self.regularization = regularization
+        self.iterations = iterations
+        self.cg_steps = cg_steps
+        self.calculate_training_loss = calculate_training_loss
+        self.random_state = random_state
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.dtype = dtype
+        
+        self.user_factors = None
+        self.item_factors = None
+        
+        # Значение функции потерь на каждой итерации.
+        self.loss_history = []
+    
+    
+    def _blocks(self, size):
+        
+        return [(start, min(start + self.block_size, size)) for start in range(0, size, self.block_size)]
+    
+    
+    def _gram(self, Y):
+        
+        return (Y.T @ Y + self.regularization * np.eye(self.factors)).astype(self.dtype)
+    
+    
+    def _update(self, Cui, X, Y, executor, YtY=None):
+        
+        if YtY is None:
+            YtY = self._gram(Y)
+        
+        def update_block(block):
+            start, end = block
+            least_squares_cg_block(Cui[start:end], X[start:end], Y, YtY, self.cg_steps)
+        
+        list(executor.map(update_block, self._blocks(X.shape[0])))
+    
+    
+    def _loss(self, Cui, X, Y, executor):
+        
+        YtY = Y.T @ Y
+        
+        def loss_block(block):
+            start, end = block
+            return block_loss(Cui[start:end], X[start:end], Y, YtY)
+        
+        loss = sum(executor.map(loss_block, self._blocks(X.shape[0])))
+        loss += self.regularization * ((X ** 2).sum() + (Y ** 2).sum())
+        
+        return loss / (Cui.data.sum() + Cui.shape[0] * Cui.shape[1] - Cui.nnz)
+    
+    
+    def fit(self, item_users, show_progress=True, warm_start=False):
+        
+        '''
+        item_users : scipy.sparse matrix, Item-User matrix of confidences (like implicit.als 0.4).
+        
+        show_progress = True : bool, print iteration time (and loss if calculate_training_loss).
+        
+        warm_start = False : bool, if True and factors exist, training continues from current factors.
+        '''
+        
+        Ciu = csr_matrix(item_users, dtype=self.dtype)
+        Cui = Ciu.T.tocsr()
+        n_items, n_users = Ciu.shape
+        
+        if not warm_start or self.user_factors is None:
+            rng = np.random.default_rng(self.random_state)
+            self.user_factors = (rng.random((n_users, self.factors)) * 0.01).astype(self.dtype)
+            self.item_factors = (rng.random((n_items, self.factors)) * 0.01).astype(self.dtype)
+        
+        self.loss_history = []
+        
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for iteration in range(self.iterations):
+                time_start = time.perf_counter()
+                
+                self._update(Cui, self.user_factors, self.item_factors, executor)
+                self._update(Ciu, self.item_factors, self.user_factors, executor)
+                
+                message = f'Iteration {iteration + 1}/{self.iterations}: {time.perf_counter() - time_start:.3f} s'
+                
+                if self.calculate_training_loss:
+                    self.loss_history.append(self._loss(Cui, self.user_factors, self.item_factors, executor))
+                    message += f', loss {self.loss_history[-1]:.6f}'
+                
+                if show_progress:
+                    print(message)
+        
+        return self
+    
+    
+    def recalculate_user(self, userid, user_items):
+        
+        '''
+        Exact least squares factors of user from user's row of User-Item matrix with fixed items' factors.
+        '''
+        
+        row = csr_matrix(user_items)[userid]
+        Y = self.item_factors.astype(np.float64)
+        Y_nnz = Y[row.indices]
+        
+        A = Y.T @ Y + self.regularization * np.eye(self.factors) + (Y_nnz.T * (row.data - 1)) @ Y_nnz
+        b = Y_nnz.T @ row.data
+        
+        return np.linalg.solve(A, b).astype(self.dtype)
+    
+    
+    def recommend(self, userid, user_items, N=10, filter_already_liked_items=True, filter_items=None,
+                  recalculate_user=False):
+        
+        '''
+        Recommend N items for user, list of tuples (item ordinal id, score) like implicit.als 0.4.
+        '''
+        
+        user = self.recalculate_user(userid, user_items) if recalculate_user else self.user_factors[userid]
+        scores = self.item_factors @ user
+        
+        if filter_already_liked_items:
+            scores[csr_matrix(user_items)[userid].indices] = -np.inf
+        
+        if filter_items:
+            scores[filter_items] = -np.inf
+        
+        best = np.argsort(-scores, kind='stable')[:N]
+        
+        return [(item, scores[item]) for item in best if np.isfinite(scores[item])]
+    
+    
+    @staticmethod
+    def _similar(factors, itemid, N):
+        
+        norms = np.linalg.norm(factors, axis=1)
+        norms[norms == 0] = 1e-10
+        scores = factors @ factors[itemid] / (norms * norms[itemid])
+        best = np.argsort(-scores, kind='stable')[:N]
+        
+        return list(zip(best, scores[best]))
+    
+    
+    def similar_users(self, userid, N=10):
+        
+        '''
+        N most similar (cosine) users, the first one is the user itself.
+        '''
+        
+        return self._similar(self.user_factors, userid, N)
+    
+    
+    def similar_items(self, itemid, N=10):
+        
+        '''
+        N most similar (cosine) items, the first one is the item itself.
+        '''
+        
+        return self._similar(self.item_factors, itemid, N)
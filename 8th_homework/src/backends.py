@@ -0,0 +1,104 @@
+import importlib
+import json
+import subprocess
+import sys
+
+
+# Реестр тяжелых библиотек: имя бэкенда -> (модуль, атрибут).
+BACKENDS = {
+    'implicit.als': ('implicit.als', 'AlternatingLeastSquares'),
+    'implicit.item_item': ('implicit.nearest_neighbours', 'ItemItemRecommender'),
+    'implicit.cosine': ('implicit.nearest_neighbours', 'CosineRecommender'),
+    'implicit.tfidf': ('implicit.nearest_neighbours', 'TFIDFRecommender'),
+    'catboost': ('catboost', 'CatBoostClassifier'),
+    'lightfm': ('lightfm', 'LightFM'),
+}
+
+# Загруженные бэкенды.
+_loaded = {}
+
+
+def register_backend(name: str, module: str, attribute: str = None):
+    
+    '''
+    Function for registering backend which will be imported lazily on first use.
+    
+    name : str, name of backend.
+    
+    module : str, name of module to import.
+    
+    attribute : str, name of module's attribute (e.g. class), if None - module itself is the backend.
+    '''
+    
+    BACKENDS[name] = (module, attribute)
+    _loaded.pop(name, None)
+
+
+def get_backend(name: str):
+    
+    '''
+    Function for getting backend, its module is imported on first call only.
+    
+    name : str, name of registered backend.
+    
+    
+    Examples
+    --------
+    >>> AlternatingLeastSquares = get_backend('implicit.als')
+    >>> CatBoostClassifier = get_backend('catboost')
+    >>> LightFM = get_backend('lightfm')
+    '''
+    
+    if name not in _loaded:
+        if name not in BACKENDS:
+            raise Exception(f'Unknown backend "{name}", available backends: {sorted(BACKENDS)}!')
+        
+        module, attribute = BACKENDS[name]
+        backend = importlib.import_module(module)
+        _loaded[name] = backend if attribute is None else getattr(backend, attribute)
+    
+    return _loaded[name]
+
+
+def is_loaded(name: str) -> bool:
+    
+    return name in _loaded
+
+
+def import_time(module: str,
+                python: str = sys.executable,
+                cwd: str = None,
+                preload: tuple = ('numpy', 'pandas'),
+                heavy_modules: tuple = ('implicit', 'catboost', 'lightfm', 'scipy')) -> 'float & list':
+    
+    '''
+    Function for measuring import time of module in a fresh interpreter (seconds),
+    e.g. to check that lightweight entry points ('src.metrics', 'src.utils') do not import heavy backends.
+    
+    module : str, name of module to import.
+    
+    python : str, path to Python interpreter.
+    
+    cwd : str, working directory of the interpreter.
+    
+    preload : tuple of modules imported before measurement (their import time is not counted).
+    
+    heavy_modules : tuple of modules to check in sys.modules after import.
+    
+    Returns import time and list of heavy modules loaded by the import.
+    
+    
+    Examples
+    --------
+    >>> elapsed, loaded = import_time('src.metrics')
+    >>> assert not loaded and elapsed < 1, 'Import of src.metrics is too heavy!'
+    '''
+    
+    code = (f'import json, sys, time; {"".join(f"import {name}; " for name in preload)}'
+            f'start = time.perf_counter(); import {module}; elapsed = time.perf_counter() - start; '
+            f'print(json.dumps([elapsed, [name for name in {tuple(heavy_modules)!r} if name in sys.modules]]))')
+    
+    output = subprocess.run([python, '-c', code], capture_output=True, text=True, check=True, cwd=cwd)
+    elapsed, loaded = json.loads(output.stdout.strip().splitlines()[-1])
+    
+    return elapsed, loaded
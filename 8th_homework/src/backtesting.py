@@ -0,0 +1,295 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from scipy.sparse import csr_matrix
+
+from .recommenders import _top_n_rows
+
+
+class WeeklyInteractions:
+    
+    '''
+    User-Item interactions partitioned by weeks.
+    
+    Interactions are stored once as week-sorted COO arrays with offsets of every week,
+    so User-Item matrix of any window of weeks is assembled by summing slices of these arrays
+    without copying and pivoting of the source DataFrame.
+    
+    Parameters
+    ----------
+    data : pd.DataFrame, dataset with history of purchases.
+    
+    feature_user_id = 'user_id' : str, contains feature name of users' ids.
+    
+    feature_item_id = 'item_id' : str, contains feature name of items' ids.
+    
+    feature_value = 'quantity' : str, contains feature name of interaction value.
+    
+    feature_week = 'week_no' : str, contains feature name of week number.
+    
+    
+    Examples
+    --------
+    >>> interactions = WeeklyInteractions(data)
+    >>> train = interactions.window(data['week_no'].min(), data['week_no'].max() - 9)
+    '''
+    
+    def __init__(self,
+                 data: pd.DataFrame,
+                 feature_user_id: str = 'user_id',
+                 feature_item_id: str = 'item_id',
+                 feature_value: str = 'quantity',
+                 feature_week: str = 'week_no'):
+        
+        # Порядковые id пользователей и товаров, общие для всех окон.
+        user_codes, self.userids = pd.factorize(data[feature_user_id], sort=True)
+        item_codes, self.itemids = pd.factorize(data[feature_item_id], sort=True)
+        
+        self.userid_to_id = dict(zip(self.userids, np.arange(len(self.userids))))
+        self.itemid_to_id = dict(zip(self.itemids, np.arange(len(self.itemids))))
+        
+        self.shape = (len(self.userids), len(self.itemids))
+        
+        # Сортировка взаимодействий по неделям.
+        weeks = data[feature_week].values
+        order = np.argsort(weeks, kind='stable')
+        
+        self.rows = user_codes[order].astype(np.int32)
+        self.cols = item_codes[order].astype(np.int32)
+        self.values = data[feature_value].values[order].astype(np.float32)
+        
+        # Смещения начала каждой недели в отсортированных массивах.
+        sorted_weeks = weeks[order]
+        self.weeks = np.unique(sorted_weeks)
+        self.offsets = np.searchsorted(sorted_weeks, np.append(self.weeks, self.weeks[-1] + 1) if len(self.weeks) else [0])
+    
+    
+    def _slice(self, start, end):
+        
+        left = self.offsets[np.searchsorted(self.weeks, start, side='left')]
+        right = self.offsets[np.searchsorted(self.weeks, end, side='left')]
+        
+        return slice(left, right)
+    
+    
+    def window(self, start, end) -> csr_matrix:
+        
+        '''
+        User-Item matrix (sum of values) of weeks from 'start' (inclusive) to 'end' (exclusive).
+        '''
+        
+        part = self._slice(start, end)
+        matrix = csr_matrix((self.values[part], (self.rows[part], self.cols[part])), shape=self.shape)
+        matrix.sum_duplicates()
+        
+        return matrix
+
+
+def rolling_windows(weeks: np.ndarray,
+                    train_weeks: 'int | None',
+                    test_weeks: int,
+                    step: int = None) -> list:
+    
+    '''
+    Function for generating rolling windows (train_start, train_end, test_start, test_end), ends are exclusive.
+    
+    weeks : array of available weeks.
+    
+    train_weeks : int, length of train window, if None - train window expands from the first week.
+    
+    test_weeks : int, length of test window.
+    
+    step : int, shift between windows, if None - equal to 'test_weeks'.
+    '''
+    
+    step = step or test_weeks
+    first, last = weeks.min(), weeks.max()
+    
+    windows = []
+    test_end = last + 1
+    
+    while True:
+        test_start = test_end - test_weeks
+        train_start = first if train_weeks is None else test_start - train_weeks
+        
+        if train_start < first or test_start <= first:
+            break
+        
+        windows.append((train_start, test_start, test_start, test_end))
+        test_end -= step
+    
+    return windows[::-1]
+
+
+def evaluate_batch(test: csr_matrix,
+                   userids: np.ndarray,
+                   predicted: np.ndarray,
+                   K: int = 5) -> 'float & float':
+    
+    '''
+    Function for calculating metrics 'Precision@K' and 'Recall@K' of batch recommendations.
+    Works like metrics.precision_at_k and metrics.recall_at_k, but on sparse test matrix.
+    
+    test : scipy.sparse.csr_matrix, User-Item matrix of test window.
+    
+    userids : array of users' ordinal ids.
+    
+    predicted : 2D array of predicted items' ordinal ids, row per user.
+    
+    K = 5 : int, number of first K recommended items will be considered.
+    '''
+    
+    if len(userids) == 0:
+        return np.nan, np.nan
+    
+    userids = np.asarray(userids)
+    predicted = predicted[:, :K]
+    
+    # Попадания ищутся по ключам (пользователь, товар) ненулевых элементов тестовой матрицы.
+    test_rows = np.repeat(np.arange(test.shape[0]), np.diff(test.indptr))
+    test_keys = test_rows.astype(np.int64) * test.shape[1] + test.indices
+    predicted_keys = userids[:, None].astype(np.int64) * test.shape[1] + predicted
+    hits = np.isin(predicted_keys, test_keys)
+    n_actual = np.diff(test.indptr)[userids]
+    
+    precision = hits.mean(axis=1).mean()
+    recall = (hits.sum(axis=1) / n_actual).mean()
+    
+    return precision, recall
+
+
+class ALSAdapter:
+    
+    '''
+    Adapter of ALS model with implicit.als 0.4 interface (fit on Item-User matrix, user_factors, item_factors),
+    e.g. als.ConjugateGradientALS or implicit.als.AlternatingLeastSquares (the model of MainRecommender),
+    to the interface of rolling_backtest: fit(user_items) and batch scoring recommend_batch.
+    
+    Parameters
+    ----------
+    model : ALS model, not fitted.
+    
+    block_size = 1024 : int, number of users in one block of scoring.
+    
+    
+    Examples
+    --------
+    >>> rolling_backtest(interactions,
+    >>>                  lambda: ALSAdapter(ConjugateGradientALS(factors=10, regularization=0.1, iterations=15)),
+    >>>                  train_weeks=None, test_weeks=3)
+    '''
+    
+    def __init__(self, model, block_size=1024):
+        
+        self.model = model
+        self.block_size = block_size
+    
+    
+    def fit(self, user_items):
+        
+        self.model.fit(csr_matrix(user_items).T.tocsr(), show_progress=False)
+        
+        return self
+    
+    
+    def recommend_batch(self, userids, user_items, N=5, filter_already_liked_items=True, filter_items=None):
+        
+        '''
+        Recommend N items for a batch of users by scores user_factors @ item_factors.T.
+        Returns two arrays of shape (len(userids), N): items' ordinal ids and scores.
+        '''
+        
+        userids = np.asarray(userids)
+        item_factors = np.asarray(self.model.item_factors, dtype=np.float32)
+        N = min(N, item_factors.shape[0])
+        
+        list_ids = [np.empty((0, N), dtype=np.int64)]
+        list_scores = [np.empty((0, N), dtype=np.float32)]
+        
+        for start in range(0, len(userids), self.block_size):
+            block = userids[start:start + self.block_size]
+            scores = np.asarray(self.model.user_factors[block], dtype=np.float32) @ item_factors.T
+            
+            if filter_already_liked_items:
+                liked = csr_matrix(user_items)[block].tocoo()
+                scores[liked.row, liked.col] = -np.inf
+            
+            if filter_items is not None and len(filter_items):
+                scores[:, filter_items] = -np.inf
+            
+            block_ids, block_scores = _top_n_rows(scores, N)
+            list_ids.append(block_ids)
+            list_scores.append(block_scores)
+        
+        return np.vstack(list_ids), np.vstack(list_scores)
+
+
+def rolling_backtest(interactions: WeeklyInteractions,
+                     model_factory,
+                     train_weeks: 'int | None',
+                     test_weeks: int,
+                     step: int = None,
+                     N: int = 5,
+                     K: int = 5,
+                     filter_already_liked_items: bool = False) -> pd.DataFrame:
+    
+    '''
+    Function for backtesting recommender on a sequence of rolling time windows.
+    
+    interactions : WeeklyInteractions, interactions partitioned by weeks.
+    
+    model_factory : callable without arguments returning new model with methods
+        fit(user_items) and recommend_batch(userids, user_items, N, filter_already_liked_items).
+        Supported models: recommenders.ItemItemKNN (e.g. lambda: recommenders.ItemItemKNN(K=5))
+        and ALS models wrapped into ALSAdapter: als.ConjugateGradientALS
+        and implicit.als.AlternatingLeastSquares (ALS of MainRecommender),
+        e.g. lambda: ALSAdapter(ConjugateGradientALS(factors=10, regularization=0.1, iterations=15)).
+    
+    train_weeks : int, length of train window, if None - train window expands from the first week.
+    
+    test_weeks : int, length of test window.
+    
+    step : int, shift between windows, if None - equal to 'test_weeks'.
+    
+    N = 5 : int, number of recommended items.
+    
+    K = 5 : int, number of first K recommended items will be considered by metrics.
+    
+    filter_already_liked_items = False : bool, exclude items from user's train history.
+    
+    Returns pd.DataFrame with metrics of every window.
+    '''
+    
+    result = []
+    
+    for train_start, train_end, test_start, test_end in rolling_windows(interactions.weeks, train_weeks, test_weeks, step):
+        train = interactions.window(train_start, train_end)
+        test = interactions.window(test_start, test_end)
+        
+        # Оцениваются только пользователи, присутствующие в обоих окнах.
+        userids = np.flatnonzero((np.diff(train.indptr) > 0) & (np.diff(test.indptr) > 0))
+        
+        time_start = time.perf_counter()
+        model = model_factory()
+        model.fit(train)
+        time_fit = time.perf_counter() - time_start
+        
+        time_start = time.perf_counter()
+        predicted, _ = model.recommend_batch(userids, train, N=N, filter_already_liked_items=filter_already_liked_items)
+        time_score = time.perf_counter() - time_start
+        
+        precision, recall = evaluate_batch(test, userids, predicted, K=K)
+        
+        result.append({'train_start': train_start,
+                       'train_end': train_end,
+                       'test_start': test_start,
+                       'test_end': test_end,
+                       'n_users': len(userids),
+                       f'precision@{K}': precision,
+                       f'recall@{K}': recall,
+                       'time_fit': time_fit,
+                       'time_score': time_score})
+    
+    return pd.DataFrame(result)
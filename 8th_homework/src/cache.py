@@ -0,0 +1,181 @@
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class RecommendationCache:
+    
+    '''
+    Cache of per-user recommendations keyed by (user_id, N, method, model_version).
+    
+    Memory is bounded by 'max_size' entries with LRU eviction, entries older than 'ttl' seconds are expired.
+    Cache is kept in process memory or, if 'path' is given, in local SQLite database,
+    so it can be shared between processes and restarts.
+    Access to cache is guarded by a lock, so one cache can be used from several threads.
+    Entries of old model versions are never returned, because model version is a part of the key,
+    so model version must be unique across all models sharing the cache (e.g. MainRecommender.model_id).
+    
+    Parameters
+    ----------
+    max_size = 100000 : int, maximal number of cached entries.
+    
+    ttl = None : float, time to live of entry in seconds, if None - entries do not expire.
+    
+    path = None : str, path to SQLite database file, if None - cache is kept in memory.
+    
+    
+    Examples
+    --------
+    >>> cache = RecommendationCache(max_size=10000)
+    >>> result_test['model_1'] = model_1.predict_cached(result_test['user_id'], cache, N=50)
+    '''
+    
+    def __init__(self, max_size=100000, ttl=None, path=None):
+        
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        
+        if path is None:
+            self._memory = OrderedDict()
+        else:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                                     '(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            self._connection.commit()
+    
+    
+    @staticmethod
+    def _key(user, N, method, model_version):
+        
+        return json.dumps([_to_python(user), N, method, model_version])
+    
+    
+    def _expired(self, created, now):
+        
+        return self.ttl is not None and now - created > self.ttl
+    
+    
+    def get_many(self, users, N, method, model_version) -> dict:
+        
+        '''
+        Cached recommendations of users, dict {user_id: list of items' ids} (users without entries are absent).
+        '''
+        
+        keys = {self._key(user, N, method, model_version): user for user in users}
+        now = time.time()
+        result = {}
+        
+        with self._lock:
+            if self.path is None:
+                for key, user in keys.items():
+                    entry = self._memory.get(key)
+                    
+                    if entry is None:
+                        continue
+                    
+                    if self._expired(entry[1], now):
+                        del self._memory[key]
+                        continue
+                    
+                    self._memory.move_to_end(key)
+                    result[user] = entry[0]
+                
+                return result
+            
+            list_keys = list(keys)
+            
+            # Запросы пакетами из-за ограничения SQLite на количество параметров.
+            for start in range(0, len(list_keys), 500):
+                part = list_keys[start:start + 500]
+                rows = self._connection.execute(f'SELECT key, value, created FROM cache '
+                                                f'WHERE key IN ({", ".join("?" * len(part))})', part).fetchall()
+                
+                hits = [(key, value) for key, value, created in rows if not self._expired(created, now)]
+                expired = [(key,) for key, _, created in rows if self._expired(created, now)]
+                
+                for key, value in hits:
+                    result[keys[key]] = json.loads(value)
+                
+                self._connection.executemany('UPDATE cache SET accessed = ? WHERE key = ?', [(now, key) for key, _ in hits])
+                
+                # Устаревшие записи удаляются, чтобы не занимать место до вытеснения по LRU.
+                self._connection.executemany('DELETE FROM cache WHERE key = ?', expired)
+            
+            self._connection.commit()
+        
+        return result
+    
+    
+    def put_many(self, users, recommendations, N, method, model_version):
+        
+        '''
+        Put recommendations of users into cache.
+        
+        users : list of users' ids.
+        
+        recommendations : list of lists of items' ids in the same order as 'users'.
+        '''
+        
+        now = time.time()
+        entries = [(self._key(user, N, method, model_version), [_to_python(item) for item in items])
+                   for user, items in zip(users, recommendations)]
+        
+        with self._lock:
+            if self.path is None:
+                for key, items in entries:
+                    self._memory[key] = (items, now)
+                    self._memory.move_to_end(key)
+                
+                while len(self._memory) > self.max_size:
+                    self._memory.popitem(last=False)
+                
+                return
+            
+            self._connection.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                                         [(key, json.dumps(items), now, now) for key, items in entries])
+            
+            # Удаление давно использованных записей сверх max_size.
+            self._connection.execute('DELETE FROM cache WHERE key IN '
+                                     '(SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+            self._connection.commit()
+    
+    
+    def get(self, user, N, method, model_version):
+        
+        return self.get_many([user], N, method, model_version).get(user)
+    
+    
+    def put(self, user, recommendation, N, method, model_version):
+        
+        self.put_many([user], [recommendation], N, method, model_version)
+    
+    
+    def clear(self):
+        
+        with self._lock:
+            if self.path is None:
+                self._memory.clear()
+            else:
+                self._connection.execute('DELETE FROM cache')
+                self._connection.commit()
+    
+    
+    def __len__(self):
+        
+        with self._lock:
+            if self.path is None:
+                return len(self._memory)
+            
+            return self._connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+def _to_python(value):
+    
+    # Перевод numpy-скаляров к типам Python для сериализации в JSON.
+    return value.item() if hasattr(value, 'item') else value
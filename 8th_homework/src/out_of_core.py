@@ -0,0 +1,464 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from scipy.sparse import csr_matrix
+
+from .als import ConjugateGradientALS
+from .als import block_loss
+from .recommenders import _top_n_rows
+
+
+# Общие файлы шардов и шаблон файлов самих шардов (CSR-массивы и временные COO-файлы).
+SHARDS_FILES = ('meta.json', 'userids.npy', 'itemids.npy', 'top_items.npy', 'item_stats.csv')
+SHARD_FILE = re.compile(r'(users|items)_\d+\.((indptr|indices|data)\.npy|(rows|cols|values|indices|data)\.tmp)')
+
+
+def _is_shards_file(name):
+    
+    return name in SHARDS_FILES or SHARD_FILE.fullmatch(name) is not None
+
+
+def _move_shards(source, target):
+    
+    # Новые файлы переносятся в целевую директорию, затем удаляются устаревшие шарды,
+    # meta.json заменяется последним, поэтому целевая директория всегда содержит meta.json.
+    os.makedirs(target, exist_ok=True)
+    names = set(os.listdir(source))
+    
+    for name in sorted(names - {'meta.json'}):
+        os.replace(os.path.join(source, name), os.path.join(target, name))
+    
+    for name in os.listdir(target):
+        if _is_shards_file(name) and name not in names:
+            os.remove(os.path.join(target, name))
+    
+    os.replace(os.path.join(source, 'meta.json'), os.path.join(target, 'meta.json'))
+    os.rmdir(source)
+
+
+def _read_chunks(source, chunksize):
+    
+    # Источник данных: путь к CSV (читается частями) или функция, возвращающая итератор DataFrame.
+    if isinstance(source, str):
+        return pd.read_csv(source, chunksize=chunksize)
+    
+    return source()
+
+
+def _coo_files_to_csr(prefix, start, n_rows, n_cols, transpose, chunksize):
+    
+    '''
+    Function for converting temporary COO-files of shard into CSR-arrays ('indptr', 'indices', 'data' npy-files)
+    by counting sort over memory-mapped files, so at most 'chunksize' interactions are resident in memory.
+    
+    prefix : str, path prefix of shard's files.
+    
+    start : int, ordinal id of the first row of shard.
+    
+    n_rows, n_cols : int, shape of shard.
+    
+    transpose : bool, if True - rows of shard are taken from 'cols' file (shards of items).
+    '''
+    
+    if os.path.exists(f'{prefix}.rows.tmp'):
+        rows = np.memmap(f'{prefix}.cols.tmp' if transpose else f'{prefix}.rows.tmp', dtype=np.int32, mode='r')
+        cols = np.memmap(f'{prefix}.rows.tmp' if transpose else f'{prefix}.cols.tmp', dtype=np.int32, mode='r')
+        values = np.memmap(f'{prefix}.values.tmp', dtype=np.float32, mode='r')
+    else:
+        rows = cols = np.array([], dtype=np.int32)
+        values = np.array([], dtype=np.float32)
+    
+    nnz = len(rows)
+    chunks = [(chunk_start, min(chunk_start + chunksize, nnz)) for chunk_start in range(0, nnz, chunksize)]
+    
+    # Количество элементов в каждой строке и смещения строк.
+    counts = np.zeros(n_rows, dtype=np.int64)
+    
+    for chunk_start, chunk_end in chunks:
+        counts += np.bincount(rows[chunk_start:chunk_end] - start, minlength=n_rows)
+    
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    
+    # Раскладка элементов по строкам: позиция элемента - следующая свободная позиция его строки.
+    indices = np.lib.format.open_memmap(f'{prefix}.indices.tmp', mode='w+', dtype=np.int32, shape=(nnz,))
+    data = np.lib.format.open_memmap(f'{prefix}.data.tmp', mode='w+', dtype=np.float32, shape=(nnz,))
+    next_position = indptr[:-1].copy()
+    
+    for chunk_start, chunk_end in chunks:
+        chunk_rows = rows[chunk_start:chunk_end] - start
+        order = np.argsort(chunk_rows, kind='stable')
+        sorted_rows = chunk_rows[order]
+        
+        rank = np.arange(len(order)) - np.searchsorted(sorted_rows, sorted_rows, side='left')
+        positions = next_position[sorted_rows] + rank
+        
+        indices[positions] = cols[chunk_start:chunk_end][order]
+        data[positions] = values[chunk_start:chunk_end][order]
+        next_position += np.bincount(chunk_rows, minlength=n_rows)
+    
+    # Суммирование повторов и сортировка индексов по блокам строк, блоки сжимаются на месте
+    # (позиция записи сжатого блока не превышает позицию его чтения).
+    new_indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    row = 0
+    position = 0
+    
+    while row < n_rows:
+        end_row = min(max(np.searchsorted(indptr, indptr[row] + chunksize, side='right') - 1, row + 1), n_rows)
+        left, right = indptr[row], indptr[end_row]
+        
+        block = csr_matrix((np.array(data[left:right]), np.array(indices[left:right]), indptr[row:end_row + 1] - left),
+                           shape=(end_row - row, n_cols))
+        block.sum_duplicates()
+        
+        indices[position:position + block.nnz] = block.indices
+        data[position:position + block.nnz] = block.data
+        new_indptr[row + 1:end_row + 1] = position + block.indptr[1:]
+        
+        position += block.nnz
+        row = end_row
+    
+    np.save(f'{prefix}.indptr.npy', new_indptr)
+    
+    for name, array in (('indices', indices), ('data', data)):
+        output = np.lib.format.open_memmap(f'{prefix}.{name}.npy', mode='w+', dtype=array.dtype, shape=(position,))
+        
+        for chunk_start in range(0, position, chunksize):
+            chunk_end = min(chunk_start + chunksize, position)
+            output[chunk_start:chunk_end] = array[chunk_start:chunk_end]
+        
+        output.flush()
+        del output
+    
+    del rows, cols, values, indices, data
+    
+    for suffix in ('rows', 'cols', 'values', 'indices', 'data'):
+        if os.path.exists(f'{prefix}.{suffix}.tmp'):
+            os.remove(f'{prefix}.{suffix}.tmp')
+
+
+class ShardedInteractions:
+    
+    '''
+    User-Item interactions stored on disk as memory-mapped CSR shards.
+    
+    Interactions are written twice: shards by ranges of users (for users' factors and scoring)
+    and shards by ranges of items (for items' factors), so any of them can be processed
+    while only one shard is resident in memory.
+    Items' statistics are built in a streaming pass over the source data: top items among kept items
+    (like MainRecommender.top_items after prefilter_items) and total values and counts of source items.
+    
+    Parameters
+    ----------
+    directory : str, directory of shards.
+    
+    
+    Examples
+    --------
+    >>> sharded = ShardedInteractions.build('retail_train.csv', 'shards', users_per_shard=100000, top=5000)
+    >>> model = OutOfCoreALS(factors=10, regularization=0.1, iterations=15).fit(sharded)
+    >>> for result in predict_sharded(model, sharded, N=5):
+    >>>     result.to_csv('recommendations.csv', mode='a', index=False)
+    '''
+    
+    def __init__(self, directory: str):
+        
+        self.directory = directory
+        
+        with open(os.path.join(directory, 'meta.json')) as file:
+            self.meta = json.load(file)
+        
+        self.userids = np.load(os.path.join(directory, 'userids.npy'), mmap_mode='r')
+        self.itemids = np.load(os.path.join(directory, 'itemids.npy'))
+        self.top_items = np.load(os.path.join(directory, 'top_items.npy'))
+        self.shape = (len(self.userids), len(self.itemids))
+    
+    
+    @classmethod
+    def build(cls,
+              source,
+              directory: str,
+              users_per_shard: int = 100000,
+              items_per_shard: int = 100000,
+              top: int = None,
+              other_category: int = 999999,
+              feature_user_id: str = 'user_id',
+              feature_item_id: str = 'item_id',
+              feature_value: str = 'quantity',
+              chunksize: int = 1000000) -> 'ShardedInteractions':
+        
+        '''
+        Build shards from source data in two streaming passes.
+        
+        source : str, path to CSV, or function without arguments returning iterator of pd.DataFrame chunks.
+        
+        directory : str, directory for shards, must be empty, absent or contain shards of previous build
+            (only files of shards are replaced, other files are kept).
+        
+        users_per_shard, items_per_shard : int, number of users (items) in one shard.
+        
+        top : int, how many the most bought items are kept (like utils.prefilter_items),
+            other items are replaced with 'other_category'. If None - all items are kept.
+        
+        other_category : int, new items id outside the top.
+        
+        feature_user_id, feature_item_id, feature_value : str, feature names of users' ids, items' ids and values.
+        
+        chunksize : int, number of rows in one chunk of CSV and number of interactions
+            in one chunk of conversion into CSR (shards are never loaded into memory entirely).
+        '''
+        
+        if os.path.isdir(directory) and os.listdir(directory) and not os.path.exists(os.path.join(directory, 'meta.json')):
+            raise Exception(f'Directory "{directory}" is not empty and does not contain shards!')
+        
+        # Шарды строятся во временной соседней директории и переносятся в 'directory' только после успешного построения.
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        build_directory = tempfile.mkdtemp(prefix=f'.{os.path.basename(os.path.abspath(directory))}.', dir=parent)
+        
+        try:
+            # Первый проход: идентификаторы пользователей и статистики товаров.
+            userids = []
+            item_values = None
+            item_counts = None
+            
+            for chunk in _read_chunks(source, chunksize):
+                userids.append(chunk[feature_user_id].unique())
+                
+                values = chunk.groupby(by=feature_item_id)[feature_value].sum()
+                counts = chunk.groupby(by=feature_item_id)[feature_user_id].size()
+                
+                item_values = values if item_values is None else item_values.add(values, fill_value=0)
+                item_counts = counts if item_counts is None else item_counts.add(counts, fill_value=0)
+            
+            userids = np.unique(np.concatenate(userids))
+            top_items = item_values.sort_values(ascending=False, kind='stable')
+            
+            if top is not None and len(top_items) > top:
+                itemids = np.unique(np.append(top_items.index.values[:top], other_category))
+                
+                # Топ товаров после замены товаров вне топа на other_category (как MainRecommender.top_items).
+                kept = np.where(item_values.index.isin(itemids), item_values.index, other_category)
+                top_items = item_values.groupby(kept).sum().sort_values(ascending=False, kind='stable')
+            else:
+                itemids = np.sort(top_items.index.values)
+            
+            np.save(os.path.join(build_directory, 'userids.npy'), userids)
+            np.save(os.path.join(build_directory, 'itemids.npy'), itemids)
+            np.save(os.path.join(build_directory, 'top_items.npy'), top_items.index.values)
+            
+            pd.DataFrame({'item_id': item_values.index,
+                          'value': item_values.values,
+                          'count': item_counts.values.astype(np.int64)})\
+                .to_csv(os.path.join(build_directory, 'item_stats.csv'), index=False)
+            
+            n_user_shards = (len(userids) - 1) // users_per_shard + 1
+            n_item_shards = (len(itemids) - 1) // items_per_shard + 1
+            
+            # Второй проход: COO-тройки дописываются во временные файлы своих шардов.
+            user_index = pd.Index(userids)
+            item_index = pd.Index(itemids)
+            other_id = item_index.get_indexer([other_category])[0]
+            
+            for chunk in _read_chunks(source, chunksize):
+                rows = user_index.get_indexer(chunk[feature_user_id]).astype(np.int32)
+                cols = item_index.get_indexer(chunk[feature_item_id]).astype(np.int32)
+                cols[cols < 0] = other_id
+                values = chunk[feature_value].values.astype(np.float32)
+                
+                for kind, keys, size in (('users', rows, users_per_shard), ('items', cols, items_per_shard)):
+                    shard_ids = keys // size
+                    
+                    for shard in np.unique(shard_ids):
+                        mask = shard_ids == shard
+                        prefix = os.path.join(build_directory, f'{kind}_{shard}')
+                        
+                        for suffix, array in (('rows', rows), ('cols', cols), ('values', values)):
+                            with open(f'{prefix}.{suffix}.tmp', 'ab') as file:
+                                array[mask].tofile(file)
+            
+            # Перевод временных COO-файлов в CSR-шарды.
+            for kind, n_shards, size, n_rows, n_cols in (('users', n_user_shards, users_per_shard, len(userids), len(itemids)),
+                                                         ('items', n_item_shards, items_per_shard, len(itemids), len(userids))):
+                for shard in range(n_shards):
+                    prefix = os.path.join(build_directory, f'{kind}_{shard}')
+                    start, end = shard * size, min((shard + 1) * size, n_rows)
+                    
+                    _coo_files_to_csr(prefix, start, end - start, n_cols, kind == 'items', chunksize)
+            
+            with open(os.path.join(build_directory, 'meta.json'), 'w') as file:
+                json.dump({'users_per_shard': users_per_shard,
+                           'items_per_shard': items_per_shard,
+                           'n_user_shards': n_user_shards,
+                           'n_item_shards': n_item_shards,
+                           'other_category': int(other_category) if other_category in itemids else None}, file)
+        except BaseException:
+            shutil.rmtree(build_directory, ignore_errors=True)
+            raise
+        
+        _move_shards(build_directory, directory)
+        
+        return cls(directory)
+    
+    
+    def _shard(self, kind, shard):
+        
+        prefix = os.path.join(self.directory, f'{kind}_{shard}')
+        indptr = np.load(f'{prefix}.indptr.npy', mmap_mode='r')
+        indices = np.load(f'{prefix}.indices.npy', mmap_mode='r')
+        data = np.load(f'{prefix}.data.npy', mmap_mode='r')
+        n_cols = self.shape[1] if kind == 'users' else self.shape[0]
+        
+        return csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, n_cols), copy=False)
+    
+    
+    def user_shards(self):
+        
+        '''
+        Iterator of (start, end, User-Item CSR matrix of users from start to end) over memory-mapped shards.
+        '''
+        
+        for shard in range(self.meta['n_user_shards']):
+            start = shard * self.meta['users_per_shard']
+            matrix = self._shard('users', shard)
+            yield start, start + matrix.shape[0], matrix
+    
+    
+    def item_shards(self):
+        
+        '''
+        Iterator of (start, end, Item-User CSR matrix of items from start to end) over memory-mapped shards.
+        '''
+        
+        for shard in range(self.meta['n_item_shards']):
+            start = shard * self.meta['items_per_shard']
+            matrix = self._shard('items', shard)
+            yield start, start + matrix.shape[0], matrix
+    
+    
+    def item_stats(self) -> pd.DataFrame:
+        
+        '''
+        Items' statistics of source data: total value and number of interactions of every item.
+        '''
+        
+        return pd.read_csv(os.path.join(self.directory, 'item_stats.csv'))
+
+
+class OutOfCoreALS(ConjugateGradientALS):
+    
+    '''
+    ConjugateGradientALS trained over ShardedInteractions: factors are updated shard by shard,
+    so only users' and items' factors and one shard are resident in memory.
+    Parameters are the same as ConjugateGradientALS.
+    '''
+    
+    def fit(self, sharded, show_progress=True, warm_start=False):
+        
+        '''
+        sharded : ShardedInteractions.
+        
+        show_progress = True : bool, print iteration time (and loss if calculate_training_loss).
+        
+        warm_start = False : bool, if True and factors exist, training continues from current factors.
+        '''
+        
+        n_users, n_items = sharded.shape
+        
+        if not warm_start or self.user_factors is None:
+            rng = np.random.default_rng(self.random_state)
+            self.user_factors = (rng.random((n_users, self.factors)) * 0.01).astype(self.dtype)
+            self.item_factors = (rng.random((n_items, self.factors)) * 0.01).astype(self.dtype)
+        
+        self.loss_history = []
+        
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for iteration in range(self.iterations):
+                time_start = time.perf_counter()
+                
+                YtY = self._gram(self.item_factors)
+                
+                for start, end, shard in sharded.user_shards():
+                    self._update(shard, self.user_factors[start:end], self.item_factors, executor, YtY)
+                
+                XtX = self._gram(self.user_factors)
+                
+                for start, end, shard in sharded.item_shards():
+                    self._update(shard, self.item_factors[start:end], self.user_factors, executor, XtX)
+                
+                message = f'Iteration {iteration + 1}/{self.iterations}: {time.perf_counter() - time_start:.3f} s'
+                
+                if self.calculate_training_loss:
+                    self.loss_history.append(self._sharded_loss(sharded))
+                    message += f', loss {self.loss_history[-1]:.6f}'
+                
+                if show_progress:
+                    print(message)
+        
+        return self
+    
+    
+    def _sharded_loss(self, sharded):
+        
+        YtY = self.item_factors.T @ self.item_factors
+        
+        loss = 0
+        total_confidence = 0
+        nnz = 0
+        
+        for start, end, shard in sharded.user_shards():
+            loss += block_loss(shard, self.user_factors[start:end], self.item_factors, YtY)
+            total_confidence += shard.data.sum()
+            nnz += shard.nnz
+        
+        loss += self.regularization * ((self.user_factors ** 2).sum() + (self.item_factors ** 2).sum())
+        
+        return loss / (total_confidence + sharded.shape[0] * sharded.shape[1] - nnz)
+
+
+def predict_sharded(model, sharded, N=5, filter_already_liked_items=False, block_size=4096):
+    
+    '''
+    Function for batch scoring of all users shard by shard.
+    
+    model : fitted model with 'user_factors' and 'item_factors' (e.g. OutOfCoreALS).
+    
+    sharded : ShardedInteractions.
+    
+    N = 5 : int, number of recommended items (all items, if there are fewer than N items).
+    
+    filter_already_liked_items = False : bool, exclude items from user's history.
+    
+    Yields pd.DataFrame with columns 'user_id' and 'predicted' (list of items' ids) for every shard.
+    '''
+    
+    other_category = sharded.meta['other_category']
+    filter_items = np.flatnonzero(sharded.itemids == other_category) if other_category is not None else []
+    item_factors = np.asarray(model.item_factors, dtype=np.float32)
+    
+    for start, end, shard in sharded.user_shards():
+        predicted = []
+        
+        for block_start in range(start, end, block_size):
+            block_end = min(block_start + block_size, end)
+            
+            scores = np.asarray(model.user_factors[block_start:block_end], dtype=np.float32) @ item_factors.T
+            scores[:, filter_items] = -np.inf
+            
+            if filter_already_liked_items:
+                liked = shard[block_start - start:block_end - start].tocoo()
+                scores[liked.row, liked.col] = -np.inf
+            
+            best, _ = _top_n_rows(scores, N)
+            predicted.extend(sharded.itemids[best])
+        
+        yield pd.DataFrame({'user_id': sharded.userids[start:end], 'predicted': [list(items) for items in predicted]})
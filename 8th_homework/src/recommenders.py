@@ -1,18 +1,37 @@
+import json
+import uuid
+
 import numpy as np
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
+
 from scipy.sparse import csr_matrix
+from scipy.sparse import vstack
+
+# Библиотеки implicit загружаются при первом обучении модели.
+from .backends import get_backend
 
-from implicit.als import AlternatingLeastSquares
-from implicit.nearest_neighbours import ItemItemRecommender
+from .als import ConjugateGradientALS
 
 
 class MainRecommender:
-    def __init__(self, random_state=None):
+    def __init__(self, random_state=None, factors_dtype='float32', als_backend='implicit'):
+        
+        assert factors_dtype in ('float32', 'float16'), 'Parametr "factors_dtype" must be "float32" or "float16"!'
+        assert als_backend in ('implicit', 'numpy'), 'Parametr "als_backend" must be "implicit" or "numpy"!'
         
         self.random_state = random_state
+        self.als_backend = als_backend
+        self.factors_dtype = factors_dtype
         self.fitted = False
         
+        # Номер обучения модели (для отображения).
+        self.model_version = 0
+        
+        # Уникальный id обученной модели, новый при каждом обучении (для инвалидации кэша прогнозов).
+        self.model_id = None
+        
         # Список наиболее покупаемых товаров.
         self.top_items = None
         
@@ -26,9 +45,21 @@ class MainRecommender:
         self.itemid_to_id = None
         self.userid_to_id = None
         
+        # Массивы user_id и item_id в порядке порядковых id.
+        self.userids = None
+        self.itemids = None
+        
         self.model_als = None
         self.model_own = None
         
+        # Векторы ALS для пакетного прогноза в типе factors_dtype (те же массивы, что и в model_als).
+        self.user_factors = None
+        self.item_factors = None
+        
+        # Квантованные в int8 векторы товаров и их масштабы.
+        self.item_factors_int8 = None
+        self.item_scales = None
+        
     
     def fit(self, data_train):
         
@@ -59,6 +90,9 @@ class MainRecommender:
         # Словари перевода user_id и item_id к порядковым id и наоброт.
         userids = self.user_item_matrix.index.values
         itemids = self.user_item_matrix.columns.values
+        
+        self.userids = userids
+        self.itemids = itemids
 
         matrix_userids = np.arange(len(userids))
         matrix_itemids = np.arange(len(itemids))
@@ -69,7 +103,9 @@ class MainRecommender:
         self.itemid_to_id = dict(zip(itemids, matrix_itemids))
         self.userid_to_id = dict(zip(userids, matrix_userids))
         
-        # Инициализация модели ALS.
+        # Инициализация модели ALS: implicit или собственная реализация на NumPy (src.als).
+        AlternatingLeastSquares = get_backend('implicit.als') if self.als_backend == 'implicit' else ConjugateGradientALS
+        
         self.model_als = AlternatingLeastSquares(factors=10,
                                                  regularization=0.1,
                                                  iterations=15,
@@ -80,15 +116,98 @@ class MainRecommender:
         # Обучение модели ALS.
         self.model_als.fit(csr_matrix(self.user_item_matrix).T.tocsr(), show_progress=True)
         
-        # Инициализация модели для собственных прогнозов пользователя.
-        self.model_own = ItemItemRecommender(K=1)
-
-        # Обучение модели Own_recommender.
-        self.model_own.fit(csr_matrix(self.user_item_matrix).T.tocsr(), show_progress=True)
+        # Инициализация и обучение модели для собственных прогнозов пользователя (Own_recommender):
+        # implicit или ItemItemKNN этого модуля без взвешивания (как ItemItemRecommender), чтобы бэкенд 'numpy' не требовал implicit.
+        if self.als_backend == 'implicit':
+            self.model_own = get_backend('implicit.item_item')(K=1)
+            self.model_own.fit(csr_matrix(self.user_item_matrix).T.tocsr(), show_progress=True)
+        else:
+            self.model_own = ItemItemKNN(K=1, weighting=None)
+            self.model_own.fit(self.sparse_user_item)
         
+        self.set_factors_dtype(self.factors_dtype)
+        
+        self.model_version += 1
+        self.model_id = uuid.uuid4().hex
         self.fitted = True
     
     
+    def set_factors_dtype(self, factors_dtype, quantize=False):
+        
+        '''
+        Store ALS factors as 'float32' or 'float16'. Factors of the ALS model itself are replaced,
+        so only one copy of factors is resident (conversion to float16 is lossy,
+        converting back to float32 does not restore precision).
+        
+        quantize : bool, if True, items' factors are also quantized into int8 for quantized scoring.
+        '''
+        
+        self.factors_dtype = factors_dtype
+        
+        self.model_als.user_factors = np.asarray(self.model_als.user_factors, dtype=factors_dtype)
+        self.model_als.item_factors = np.asarray(self.model_als.item_factors, dtype=factors_dtype)
+        
+        self.user_factors = self.model_als.user_factors
+        self.item_factors = self.model_als.item_factors
+        
+        self.item_factors_int8 = None
+        self.item_scales = None
+        
+        if quantize:
+            self.quantize_item_factors()
+    
+    
+    def quantize_item_factors(self, item_block=4096):
+        
+        '''
+        Quantize items' factors into int8 with per-item scale = max absolute value / 127 (by blocks of items).
+        '''
+        
+        n_items = len(self.item_factors)
+        self.item_scales = np.empty(n_items, dtype=np.float32)
+        self.item_factors_int8 = np.empty(self.item_factors.shape, dtype=np.int8)
+        
+        for start in range(0, n_items, item_block):
+            factors = self.item_factors[start:start + item_block].astype(np.float32)
+            scales = np.abs(factors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            
+            self.item_scales[start:start + item_block] = scales
+            self.item_factors_int8[start:start + item_block] = np.round(factors / scales[:, None])
+    
+    
+    def factors_nbytes(self):
+        
+        '''
+        Memory of all resident factors' arrays (ALS model's, reduced precision and quantized) in bytes.
+        '''
+        
+        arrays = [self.model_als.user_factors, self.model_als.item_factors,
+                  self.user_factors, self.item_factors, self.item_factors_int8, self.item_scales]
+        
+        return sum({id(array): array.nbytes for array in arrays if array is not None}.values())
+    
+    
+    def _score_items(self, user_factors, quantized=False, item_block=4096):
+        
+        # Прогноз по блокам товаров: квантованные векторы умножаются без копии во float32,
+        # вещественные векторы приводятся к float32 только в пределах текущего блока.
+        n_items = len(self.item_factors)
+        scores = np.empty((len(user_factors), n_items), dtype=np.float32)
+        
+        for start in range(0, n_items, item_block):
+            end = min(start + item_block, n_items)
+            
+            if quantized:
+                np.matmul(user_factors, self.item_factors_int8[start:end].T, out=scores[:, start:end], dtype=np.float32)
+                scores[:, start:end] *= self.item_scales[start:end]
+            else:
+                item_factors = self.item_factors[start:end].astype(np.float32, copy=False)
+                scores[:, start:end] = user_factors @ item_factors.T
+        
+        return scores
+    
+    
     # Метод для дополнения прогноза популярными товарами.
     def add_top_items(self, res, N):
         
@@ -139,8 +258,13 @@ class MainRecommender:
             recs = self.model_own.recommend(userid=similar_user,
                                             user_items=self.sparse_user_item,
                                             N=N,
+                                            filter_already_liked_items=False,
                                             filter_items=[self.itemid_to_id[other_category]])
 
+            # пропустить пользователя, если все его товары отфильтрованы (ближайший сосед товаров - other_category),
+            if not recs:
+                continue
+
             # выбрать первый продукт.
             item = recs[0][0]
 
@@ -161,3 +285,862 @@ class MainRecommender:
         res = self.add_top_items(res, N)
         
         return res
+    
+    
+    # Метод для перевода user_id к порядковым id, для неизвестных пользователей -1.
+    def get_user_ids(self, users):
+        
+        return pd.Series(users).map(self.userid_to_id).fillna(-1).astype(np.int64).values
+    
+    
+    # Метод для перевода порядковых id к item_id.
+    def get_item_ids(self, ids):
+        
+        return np.asarray(self.itemids)[ids]
+    
+    
+    def predict_als_batch(self, users, N=5, other_category=999999, block_size=1024, cold_start=None,
+                          quantized=False, shortlist=None):
+        
+        '''
+        Batch version of predict_als: items are scored as user_factors @ item_factors.T by blocks of users.
+        Unlike predict_als, stored users' factors are used (recalculate_user=False)
+        and items are returned sorted by score.
+        Unknown users get items from 'cold_start' or the most bought items if 'cold_start' is None.
+        
+        users : list of users' ids.
+        
+        cold_start : fitted ColdStartRecommender for unknown users.
+        
+        quantized : bool, if True, items are scored with int8 quantized factors
+            and 'shortlist' best items are re-ranked with exact float32 scores.
+        
+        shortlist : int, size of shortlist for re-ranking, if None - 4 * N (not less than N).
+        
+        Returns list of N items' ids for every user (fewer than N, if there are fewer than N items).
+        '''
+        
+        assert self.fitted, 'MainRecommender must be fitted before applying!'
+        
+        ids = self.get_user_ids(users)
+        known = ids >= 0
+        
+        _, items = self._predict_als_ids(ids[known], N, other_category, block_size, quantized, shortlist)
+        
+        res = [None] * len(ids)
+        
+        for position, row in zip(np.flatnonzero(known), self.get_item_ids(items)):
+            res[position] = row
+        
+        # Прогноз для неизвестных пользователей одним обращением к таблицам популярности
+        # (таблицы могут быть короче N, если товаров в каталоге меньше N).
+        if not known.all():
+            unknown = np.flatnonzero(~known)
+            
+            if cold_start is not None:
+                top_items = cold_start.predict(np.asarray(users)[unknown], N=N)
+            else:
+                top_items = [np.array([item for item in self.top_items if item != other_category][:N])] * len(unknown)
+            
+            for position, row in zip(unknown, top_items):
+                res[position] = row
+        
+        return res
+    
+    
+    def _predict_als_ids(self, ids, N, other_category=999999, block_size=1024, quantized=False, shortlist=None):
+        
+        # Прогноз ALS в порядковых id для известных пользователей (ids >= 0).
+        filter_items = [self.itemid_to_id[other_category]] if other_category in self.itemid_to_id else []
+        
+        list_ids = []
+        list_scores = []
+        
+        if quantized and self.item_factors_int8 is None:
+            self.quantize_item_factors()
+        
+        # Короткий список не может быть меньше N.
+        shortlist = max(shortlist or 4 * N, N)
+        
+        for start in range(0, len(ids), block_size):
+            user_factors = self.user_factors[ids[start:start + block_size]].astype(np.float32)
+            
+            scores = self._score_items(user_factors, quantized)
+            scores[:, filter_items] = -np.inf
+            
+            if not quantized:
+                block_ids, block_scores = _top_n_rows(scores, N)
+            else:
+                # Приближенный прогноз по квантованным векторам товаров и точный прогноз float32 для короткого списка.
+                candidates, _ = _top_n_rows(scores, shortlist)
+                
+                exact = np.einsum('uf,ucf->uc', user_factors, self.item_factors[candidates].astype(np.float32))
+                exact[np.isin(candidates, filter_items)] = -np.inf
+                
+                best, block_scores = _top_n_rows(exact, N)
+                block_ids = np.take_along_axis(candidates, best, axis=1)
+            
+            list_ids.append(block_ids)
+            list_scores.append(block_scores)
+        
+        if not list_ids:
+            width = min(N, len(self.item_factors))
+            return np.empty((0, width)), np.empty((0, width), dtype=np.int64)
+        
+        return np.vstack(list_scores), np.vstack(list_ids)
+    
+    
+    def predict_cached(self, users, cache, N=5, method='predict_als_batch', **kwargs):
+        
+        '''
+        Prediction with cache of recommendations (e.g. cache.RecommendationCache):
+        only users absent from cache for current fitted model (model_id) are scored.
+        
+        users : list of users' ids.
+        
+        cache : object with methods get_many and put_many.
+        
+        method : str, 'predict_als_batch' (batch scoring), 'predict_als' or 'predict_sur' (scoring user by user).
+        
+        kwargs : parameters of the method, fitted models (e.g. cold_start) are identified in cache by their model_id.
+        
+        Returns list of N items' ids for every user.
+        '''
+        
+        assert self.fitted, 'MainRecommender must be fitted before applying!'
+        assert method in ('predict_als_batch', 'predict_als', 'predict_sur'), 'Unknown prediction method!'
+        
+        users = list(users)
+        cache_method = json.dumps([method, self.factors_dtype,
+                                   sorted((key, _cache_param(value)) for key, value in kwargs.items())])
+        
+        res = cache.get_many(users, N, cache_method, self.model_id)
+        misses = [*dict.fromkeys(user for user in users if user not in res)]
+        
+        if misses:
+            if method == 'predict_als_batch':
+                predicted = self.predict_als_batch(misses, N=N, **kwargs)
+            else:
+                predicted = [getattr(self, method)(user, N=N, **kwargs) for user in misses]
+            
+            cache.put_many(misses, predicted, N, cache_method, self.model_id)
+            res.update(zip(misses, predicted))
+        
+        return [list(res[user]) for user in users]
+
+
+def _cache_param(value):
+    
+    # Стабильное представление параметра прогноза в ключе кэша: обученные модели - по их model_id.
+    if hasattr(value, 'model_id'):
+        return [type(value).__name__, value.model_id]
+    
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    
+    if isinstance(value, (list, tuple)):
+        return [_cache_param(item) for item in value]
+    
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    
+    raise Exception(f'Parameter of type "{type(value).__name__}" can not be a part of cache key!')
+
+
+# Функции взвешивания Item-User матрицы для ItemItemKNN (строки - товары, столбцы - пользователи).
+def _idf(item_user):
+    
+    n_items = float(item_user.shape[0])
+    
+    return np.log(n_items) - np.log1p(np.bincount(item_user.indices, minlength=item_user.shape[1]))
+
+
+def tfidf_weight(item_user):
+    
+    '''
+    TF-IDF weighting of Item-User matrix (same formula as implicit.nearest_neighbours.tfidf_weight).
+    
+    item_user : scipy.sparse matrix, rows are items, columns are users.
+    '''
+    
+    weighted = csr_matrix(item_user, dtype=np.float32, copy=True)
+    idf = _idf(weighted)
+    weighted.data = (np.sqrt(weighted.data) * idf[weighted.indices]).astype(np.float32)
+    
+    return weighted
+
+
+def bm25_weight(item_user, K1=1.2, B=0.75):
+    
+    '''
+    Okapi BM25 weighting of Item-User matrix (same formula as implicit.nearest_neighbours.bm25_weight).
+    
+    item_user : scipy.sparse matrix, rows are items, columns are users.
+    
+    K1 : float, term frequency saturation.
+    
+    B : float, length normalization.
+    '''
+    
+    weighted = csr_matrix(item_user, dtype=np.float32, copy=True)
+    idf = _idf(weighted)
+    
+    row_sums = np.asarray(weighted.sum(axis=1)).ravel()
+    length_norm = (1.0 - B) + B * row_sums / row_sums.mean()
+    row = np.repeat(np.arange(weighted.shape[0]), np.diff(weighted.indptr))
+    
+    weighted.data = (weighted.data * (K1 + 1.0) / (K1 * length_norm[row] + weighted.data) * idf[weighted.indices]).astype(np.float32)
+    
+    return weighted
+
+
+def _l2_normalize_rows(matrix):
+    
+    '''
+    L2 normalization of rows of CSR matrix (in place), empty rows are kept as is.
+    '''
+    
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    row = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    matrix.data /= norms[row].astype(matrix.dtype)
+    
+    return matrix
+
+
+def _top_k_csr(matrix, K):
+    
+    '''
+    Keep only K largest values in each row of CSR matrix (vectorized over the whole matrix).
+    '''
+    
+    matrix.sum_duplicates()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    
+    # Сортировка значений внутри строки по убыванию и отсечение по рангу в строке.
+    order = np.lexsort((-matrix.data, rows))
+    rank = np.arange(len(order)) - matrix.indptr[rows[order]]
+    keep = order[rank < K]
+    
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[keep], minlength=matrix.shape[0]), out=indptr[1:])
+    
+    return csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+
+def _top_n_rows(scores, N):
+    
+    '''
+    Indices and values of N largest values in each row of dense 2D array, sorted by descending.
+    '''
+    
+    N = min(N, scores.shape[1])
+    
+    if N == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+    
+    best = np.argpartition(-scores, N - 1, axis=1)[:, :N]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class ItemItemKNN:
+    
+    '''
+    Item-Item kNN recommender (Cosine, TF-IDF, BM25 weighting or unweighted).
+    
+    Item-Item similarity is computed by blocks of items with sparse matrix multiplication,
+    only K nearest neighbours of every item are kept, so similarity matrix memory is bounded by n_items * K.
+    Users are scored by batches as user_rows @ similarity.
+    Blocks of items and batches of users are processed in thread pool.
+    
+    Parameters
+    ----------
+    K = 20 : int, number of nearest neighbours kept for every item.
+    
+    weighting = 'cosine' : str, one of 'cosine', 'tfidf', 'bm25' or None - unnormalized dot products
+        of items' vectors (like implicit.nearest_neighbours.ItemItemRecommender).
+    
+    K1 = 1.2, B = 0.75 : float, parameters of BM25 weighting.
+    
+    block_size = 1024 : int, number of items (users) in one block of similarity computation (scoring).
+    
+    num_threads = None : int, number of threads, if None - number of processors.
+    
+    
+    Examples
+    --------
+    >>> model = ItemItemKNN(K=5, weighting='tfidf')
+    >>> model.fit(sparse_user_item)
+    >>> ids, scores = model.recommend_batch(np.arange(10), sparse_user_item, N=5)
+    '''
+    
+    weightings = (None, 'cosine', 'tfidf', 'bm25')
+    
+    def __init__(self, K=20, weighting='cosine', K1=1.2, B=0.75, block_size=1024, num_threads=None):
+        
+        assert weighting in self.weightings, f'Parametr "weighting" must be one of {self.weightings}!'
+        
+        self.K = K
+        self.weighting = weighting
+        self.K1 = K1
+        self.B = B
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.fitted = False
+        
+        # Item-Item матрица сходства (только K ближайших соседей каждого товара).
+        self.similarity = None
+    
+    
+    def _weight(self, item_user):
+        
+        # Нормирование векторов товаров, как в implicit (TFIDFRecommender и CosineRecommender).
+        if self.weighting == 'tfidf':
+            return _l2_normalize_rows(tfidf_weight(item_user))
+        
+        if self.weighting == 'bm25':
+            return bm25_weight(item_user, K1=self.K1, B=self.B)
+        
+        if self.weighting is None:
+            return csr_matrix(item_user, dtype=np.float32, copy=True)
+        
+        return _l2_normalize_rows(csr_matrix(item_user, dtype=np.float32, copy=True))
+    
+    
+    def _blocks(self, size):
+        
+        return [(start, min(start + self.block_size, size)) for start in range(0, size, self.block_size)]
+    
+    
+    def _map(self, function, blocks):
+        
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            return list(executor.map(function, blocks))
+    
+    
+    def fit(self, user_items):
+        
+        '''
+        user_items : scipy.sparse matrix, User-Item matrix (rows are users, columns are items).
+        '''
+        
+        weighted = self._weight(csr_matrix(user_items).T.tocsr())
+        weighted_t = weighted.T.tocsr()
+        
+        # Сходство блока товаров со всеми товарами с отбором K ближайших соседей.
+        def similarity_block(block):
+            start, end = block
+            return _top_k_csr((weighted[start:end] @ weighted_t).tocsr(), self.K)
+        
+        self.similarity = vstack(self._map(similarity_block, self._blocks(weighted.shape[0]))).tocsr()
+        self.fitted = True
+        
+        return self
+    
+    
+    def recommend_batch(self, userids, user_items, N=5, filter_already_liked_items=True, filter_items=None):
+        
+        '''
+        Recommend N items for a batch of users.
+        
+        userids : array of users' ordinal ids (rows of user_items).
+        
+        user_items : scipy.sparse matrix, User-Item matrix.
+        
+        N = 5 : int, number of recommended items.
+        
+        filter_already_liked_items = True : bool, exclude items from user's history.
+        
+        filter_items = None : list of items' ordinal ids to exclude.
+        
+        Returns two arrays of shape (len(userids), N): items' ordinal ids and scores.
+        '''
+        
+        assert self.fitted, 'ItemItemKNN must be fitted before applying!'
+        
+        userids = np.asarray(userids)
+        user_rows = csr_matrix(user_items)[userids]
+        
+        def score_block(block):
+            start, end = block
+            rows = user_rows[start:end]
+            scores = (rows @ self.similarity).toarray()
+            
+            if filter_already_liked_items:
+                liked = rows.tocoo()
+                scores[liked.row, liked.col] = -np.inf
+            
+            if filter_items is not None and len(filter_items):
+                scores[:, filter_items] = -np.inf
+            
+            return _top_n_rows(scores, N)
+        
+        results = self._map(score_block, self._blocks(len(userids)))
+        
+        if not results:
+            return np.empty((0, N), dtype=np.int64), np.empty((0, N), dtype=np.float32)
+        
+        return np.vstack([ids for ids, _ in results]), np.vstack([scores for _, scores in results])
+    
+    
+    def recommend(self, userid, user_items, N=5, filter_already_liked_items=True, filter_items=None):
+        
+        '''
+        Recommend N items for one user, list of tuples (item ordinal id, score) like implicit does.
+        Items with zero or filtered score are not returned.
+        '''
+        
+        ids, scores = self.recommend_batch([userid], user_items, N, filter_already_liked_items, filter_items)
+        
+        return [(item, score) for item, score in zip(ids[0], scores[0]) if np.isfinite(score) and score > 0]
+    
+    
+    def similar_items(self, itemid, N=10):
+        
+        '''
+        N nearest neighbours of item, list of tuples (item ordinal id, similarity).
+        '''
+        
+        assert self.fitted, 'ItemItemKNN must be fitted before applying!'
+        
+        row = self.similarity[itemid]
+        order = np.argsort(-row.data, kind='stable')[:N]
+        
+        return list(zip(row.indices[order], row.data[order]))
+
+
+class CandidateGenerator:
+    
+    '''
+    Candidate generation for the second level model from several sources of fitted MainRecommender.
+    
+    Sources (all are computed in batched form):
+    'als' - top items by ALS scores (like predict_als),
+    'own' - user's own most bought items,
+    'similar_items' - the most similar by ALS item to every of user's own most bought items
+        (like get_similar_items_recommendation),
+    'similar_users' - the most bought item of every of the most similar by ALS users (like predict_sur),
+    'top' - the most bought items overall.
+    
+    Candidates of all sources are united per user with deduplication,
+    rank of candidate in every source is kept as feature (0 - candidate is absent in the source),
+    candidates are sorted by the best rank and cut to 'max_candidates' per user.
+    Unknown users get candidates from 'top' source only (segment's top items if 'cold_start' is given).
+    
+    Parameters
+    ----------
+    recommender : fitted MainRecommender.
+    
+    sources = None : dict {source: number of candidates}, if None - 50 candidates of every source.
+    
+    max_candidates = 100 : int, maximal number of candidates per user.
+    
+    other_category = 999999 : int, items' id which is excluded from candidates.
+    
+    block_size = 1024 : int, number of users (items) in one block of computation.
+    
+    cold_start = None : fitted ColdStartRecommender, if given, 'top' source is taken from its segment tables.
+    
+    
+    Examples
+    --------
+    >>> generator = CandidateGenerator(model_1, sources={'als': 50, 'own': 20, 'top': 20})
+    >>> candidates = generator.generate(result_valid['user_id'])
+    >>> X_train = utils.prepare_result_lvl_2(data=result_valid, candidates=candidates)
+    '''
+    
+    all_sources = ('als', 'own', 'similar_items', 'similar_users', 'top')
+    
+    def __init__(self, recommender, sources=None, max_candidates=100, other_category=999999, block_size=1024,
+                 cold_start=None):
+        
+        assert recommender.fitted, 'MainRecommender must be fitted before applying!'
+        
+        if sources is None:
+            sources = {source: 50 for source in self.all_sources}
+        
+        for source in sources:
+            assert source in self.all_sources, f'Source must be one of {self.all_sources}!'
+        
+        self.recommender = recommender
+        self.sources = sources
+        self.max_candidates = max_candidates
+        self.other_category = other_category
+        self.block_size = block_size
+        self.cold_start = cold_start
+        
+        self.filter_items = [recommender.itemid_to_id[other_category]] if other_category in recommender.itemid_to_id else []
+        
+        # Кэш вспомогательных массивов, рассчитываемых один раз для всех пользователей.
+        self._similar_item = None
+        self._best_own_item = None
+    
+    
+    def _blocks(self, size):
+        
+        return [(start, min(start + self.block_size, size)) for start in range(0, size, self.block_size)]
+    
+    
+    def _own_scores(self, ids):
+        
+        scores = self.recommender.sparse_user_item[ids].toarray()
+        scores[:, self.filter_items] = 0
+        
+        return scores
+    
+    
+    def _top_own(self, ids, N):
+        
+        # Пустые массивы нужной ширины - на случай, когда в пакете нет известных пользователей.
+        width = min(N, self.recommender.sparse_user_item.shape[1])
+        list_ids = [np.empty((0, width), dtype=np.int64)]
+        list_scores = [np.empty((0, width), dtype=np.float32)]
+        
+        for start, end in self._blocks(len(ids)):
+            block_ids, block_scores = _top_n_rows(self._own_scores(ids[start:end]), N)
+            list_ids.append(block_ids)
+            list_scores.append(block_scores)
+        
+        return np.vstack(list_ids), np.vstack(list_scores)
+    
+    
+    def _get_similar_item(self):
+        
+        # Для каждого товара - наиболее похожий по векторам ALS товар, кроме самого товара.
+        if self._similar_item is None:
+            factors = self.recommender.item_factors.astype(np.float32)
+            factors = factors / np.maximum(np.linalg.norm(factors, axis=1, keepdims=True), 1e-10)
+            
+            self._similar_item = np.empty(len(factors), dtype=np.int64)
+            
+            for start, end in self._blocks(len(factors)):
+                scores = factors[start:end] @ factors.T
+                scores[np.arange(end - start), np.arange(start, end)] = -np.inf
+                scores[:, self.filter_items] = -np.inf
+                self._similar_item[start:end] = scores.argmax(axis=1)
+        
+        return self._similar_item
+    
+    
+    def _get_best_own_item(self):
+        
+        # Для каждого пользователя - наиболее покупаемый им товар (-1, если таких нет).
+        if self._best_own_item is None:
+            ids, scores = self._top_own(np.arange(self.recommender.sparse_user_item.shape[0]), 1)
+            self._best_own_item = np.where(scores[:, 0] > 0, ids[:, 0], -1)
+        
+        return self._best_own_item
+    
+    
+    def _source_als(self, ids, N):
+        
+        _, items = self.recommender._predict_als_ids(ids, N, self.other_category, self.block_size)
+        
+        return items, np.ones(items.shape, dtype=bool)
+    
+    
+    def _source_own(self, ids, N):
+        
+        items, scores = self._top_own(ids, N)
+        
+        return items, scores > 0
+    
+    
+    def _source_similar_items(self, ids, N):
+        
+        items, scores = self._top_own(ids, N)
+        
+        return self._get_similar_item()[items], scores > 0
+    
+    
+    def _source_similar_users(self, ids, N):
+        
+        factors = self.recommender.user_factors.astype(np.float32)
+        factors = factors / np.maximum(np.linalg.norm(factors, axis=1, keepdims=True), 1e-10)
+        best_own_item = self._get_best_own_item()
+        
+        list_items = [np.empty((0, min(N, len(factors))), dtype=np.int64)]
+        
+        for start, end in self._blocks(len(ids)):
+            scores = factors[ids[start:end]] @ factors.T
+            scores[np.arange(end - start), ids[start:end]] = -np.inf
+            similar_users, _ = _top_n_rows(scores, N)
+            list_items.append(best_own_item[similar_users])
+        
+        items = np.vstack(list_items)
+        
+        return items, items >= 0
+    
+    
+    def _source_top(self, users, N):
+        
+        if self.cold_start is not None:
+            top_items = self.cold_start.predict(users, N=N)
+        else:
+            top_items = np.array([item for item in self.recommender.top_items if item != self.other_category][:N])
+            top_items = np.tile(top_items, (len(users), 1))
+        
+        # Товары, отсутствующие в User-Item матрице, не могут быть кандидатами.
+        items = pd.Series(top_items.ravel()).map(self.recommender.itemid_to_id).fillna(-1).astype(np.int64).values
+        items = items.reshape(top_items.shape)
+        
+        return np.maximum(items, 0), items >= 0
+    
+    
+    def generate(self, users) -> pd.DataFrame:
+        
+        '''
+        Generate candidates for users.
+        
+        users : list of users' ids.
+        
+        Returns long format pd.DataFrame with columns 'user_id', 'item_id',
+        'rank_<source>' for every source and 'n_sources' - number of sources of the candidate.
+        '''
+        
+        users = pd.unique(np.asarray(users))
+        ids = self.recommender.get_user_ids(users)
+        known = np.flatnonzero(ids >= 0)
+        
+        n_items = len(self.recommender.itemids)
+        list_keys = []
+        list_sources = []
+        list_ranks = []
+        
+        for source_code, (source, N) in enumerate(self.sources.items()):
+            # Источник 'top' применим ко всем пользователям, остальные - только к известным.
+            if source == 'top':
+                positions = np.arange(len(users))
+                items, mask = self._source_top(users, N)
+            else:
+                positions = known
+                items, mask = getattr(self, f'_source_{source}')(ids[positions], N)
+            
+            if items.size == 0:
+                continue
+            
+            ranks = np.broadcast_to(np.arange(1, items.shape[1] + 1), items.shape)
+            keys = positions[:, None].astype(np.int64) * n_items + items
+            
+            list_keys.append(keys[mask])
+            list_sources.append(np.full(mask.sum(), source_code))
+            list_ranks.append(ranks[mask])
+        
+        columns_rank = [f'rank_{source}' for source in self.sources]
+        
+        if not list_keys:
+            return pd.DataFrame(columns=['user_id', 'item_id'] + columns_rank + ['n_sources'])
+        
+        keys = np.concatenate(list_keys)
+        sources = np.concatenate(list_sources)
+        ranks = np.concatenate(list_ranks)
+        
+        # Объединение источников с удалением дубликатов: одна строка на пару пользователь-товар.
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        
+        max_rank = np.iinfo(np.int32).max
+        rank_matrix = np.full((len(unique_keys), len(self.sources)), max_rank, dtype=np.int32)
+        np.minimum.at(rank_matrix, (inverse, sources), ranks)
+        
+        best_rank = rank_matrix.min(axis=1)
+        n_sources = (rank_matrix < max_rank).sum(axis=1)
+        rank_matrix[rank_matrix == max_rank] = 0
+        
+        positions = unique_keys // n_items
+        items = unique_keys % n_items
+        
+        # Сортировка кандидатов пользователя по лучшему рангу и ограничение их количества.
+        order = np.lexsort((-n_sources, best_rank, positions))
+        positions = positions[order]
+        group_start = np.searchsorted(positions, positions, side='left')
+        keep = order[np.arange(len(order)) - group_start < self.max_candidates]
+        
+        result = pd.DataFrame(rank_matrix[keep], columns=columns_rank)
+        result.insert(0, 'user_id', users[unique_keys[keep] // n_items])
+        result.insert(1, 'item_id', self.recommender.get_item_ids(items[keep]))
+        result['n_sources'] = n_sources[keep].astype(np.int8)
+        
+        return result
+
+
+class ColdStartRecommender:
+    
+    '''
+    Recommender of the most bought items per users' demographic segment (e.g. hh_demographic.csv features)
+    with global fallback for users without demographic data.
+    
+    Top-N items are precomputed as dense array indexed by segment code (the last row is global top),
+    so a batch of users is predicted with one vectorized lookup.
+    
+    Parameters
+    ----------
+    segment_features = ('age_desc', 'income_desc') : features of users which define segment.
+    
+    N = 50 : int, number of items kept for every segment.
+    
+    other_category = 999999 : int, items' id which is excluded from recommendations.
+    
+    
+    Examples
+    --------
+    >>> cold_start = ColdStartRecommender().fit(data_train, user_features)
+    >>> result_test['model_1'] = model_1.predict_als_batch(result_test['user_id'], N=50, cold_start=cold_start)
+    '''
+    
+    def __init__(self, segment_features=('age_desc', 'income_desc'), N=50, other_category=999999):
+        
+        self.segment_features = list(segment_features)
+        self.N = N
+        self.other_category = other_category
+        self.fitted = False
+        
+        # Код сегмента каждого пользователя.
+        self.user_segment = None
+        
+        # Значения признаков сегментов.
+        self.segments = None
+        
+        # Таблицы популярных товаров: строка на сегмент, последняя строка - общий топ.
+        self.top_items = None
+        
+        # Уникальный id обученной модели (для ключей кэша прогнозов).
+        self.model_id = None
+    
+    
+    def fit(self, data_train, user_features, feature_user_id='user_id', feature_item_id='item_id', feature_to_top='quantity'):
+        
+        '''
+        data_train : pd.DataFrame, dataset with history of purchases.
+        
+        user_features : pd.DataFrame, users' features with 'segment_features' columns.
+        '''
+        
+        users = user_features.drop_duplicates(subset=feature_user_id)
+        segment_codes, self.segments = pd.MultiIndex.from_frame(users[self.segment_features].astype(str)).factorize()
+        self.user_segment = pd.Series(segment_codes, index=users[feature_user_id].values)
+        
+        data = data_train[data_train[feature_item_id] != self.other_category]
+        
+        # Общий топ товаров; ширина таблиц ограничена количеством товаров в каталоге, чтобы не было повторов.
+        global_top = (
+            data
+            .groupby(by=feature_item_id)[feature_to_top]
+            .sum()
+            .sort_values(ascending=False)
+            .index
+            .values
+        )
+        
+        n_top = min(self.N, len(global_top))
+        global_top = global_top[:n_top]
+        
+        self.top_items = np.tile(global_top, (len(self.segments) + 1, 1))
+        
+        # Топ товаров каждого сегмента, дополненный общим топом.
+        popularity = (
+            data
+            .assign(segment=data[feature_user_id].map(self.user_segment))
+            .dropna(subset=['segment'])
+            .groupby(by=['segment', feature_item_id])[feature_to_top]
+            .sum()
+            .reset_index()
+            .sort_values(by=['segment', feature_to_top], ascending=[True, False])
+        )
+        
+        for segment, items in popularity.groupby(by='segment')[feature_item_id]:
+            items = items.values[:n_top]
+            self.top_items[int(segment)] = np.concatenate([items, global_top[~np.isin(global_top, items)]])[:n_top]
+        
+        self.model_id = uuid.uuid4().hex
+        self.fitted = True
+        
+        return self
+    
+    
+    def predict(self, users, N=5):
+        
+        '''
+        users : list of users' ids.
+        
+        Returns 2D array of N items' ids for every user
+        (fewer than N, if there are fewer than N items in the catalog).
+        '''
+        
+        assert self.fitted, 'ColdStartRecommender must be fitted before applying!'
+        assert N <= self.N, f'N must not exceed {self.N}!'
+        
+        codes = pd.Series(np.asarray(users)).map(self.user_segment).fillna(-1).astype(np.int64).values
+        
+        return self.top_items[codes, :N]
+
+
+def benchmark_als_scoring(recommender, result, N=5, K=5, feature_user_id='user_id', feature_actual='actual',
+                          shortlist=None, repeats=3):
+    
+    '''
+    Benchmark of MainRecommender batch scoring with reduced precision and quantized factors
+    against exact float32 scoring: throughput (users per second), resident factors' memory,
+    memory of items' factors scanned per user and Precision@K delta.
+    
+    recommender : fitted MainRecommender.
+    
+    result : pd.DataFrame with users' ids and lists of actual items (e.g. from utils.prepare_result).
+    
+    Returns pd.DataFrame with a row per scoring mode.
+    
+    
+    Examples
+    --------
+    >>> benchmark_als_scoring(model_1, result_valid, N=50, K=5)
+    '''
+    
+    from time import perf_counter
+    from .metrics import precision_at_k
+    
+    # Исходные векторы сохраняются, так как перевод во float16 необратим.
+    factors_dtype = recommender.factors_dtype
+    quantized_original = recommender.item_factors_int8 is not None
+    user_factors = recommender.model_als.user_factors.copy()
+    item_factors = recommender.model_als.item_factors.copy()
+    
+    users = result[feature_user_id]
+    modes = [('float32', 'float32', False), ('float16', 'float16', False), ('int8 + float32 re-rank', 'float32', True)]
+    
+    df_benchmark = pd.DataFrame()
+    
+    # Исходное состояние модели восстанавливается и при ошибке.
+    try:
+        for mode, dtype, quantized in modes:
+            recommender.model_als.user_factors = user_factors.astype(np.float32)
+            recommender.model_als.item_factors = item_factors.astype(np.float32)
+            recommender.set_factors_dtype(dtype, quantize=quantized)
+            
+            time_best = np.inf
+            
+            for _ in range(repeats):
+                time_start = perf_counter()
+                predicted = recommender.predict_als_batch(users, N=N, quantized=quantized, shortlist=shortlist)
+                time_best = min(time_best, perf_counter() - time_start)
+            
+            df_benchmark.loc[mode, 'users_per_second'] = len(users) / time_best
+            # Память всех хранимых векторов и объем векторов товаров, читаемых при полном проходе по каталогу.
+            df_benchmark.loc[mode, 'factors_mb'] = recommender.factors_nbytes() / 2 ** 20
+            df_benchmark.loc[mode, 'scan_mb'] = (
+                recommender.item_factors_int8.nbytes + recommender.item_scales.nbytes if quantized
+                else recommender.item_factors.nbytes
+            ) / 2 ** 20
+            df_benchmark.loc[mode, f'precision@{K}'] = precision_at_k(result[feature_actual],
+                                                                      pd.Series(predicted, index=result.index),
+                                                                      K=K)
+    finally:
+        recommender.model_als.user_factors = user_factors
+        recommender.model_als.item_factors = item_factors
+        recommender.set_factors_dtype(factors_dtype, quantize=quantized_original)
+    
+    df_benchmark['speedup'] = df_benchmark['users_per_second'] / df_benchmark.loc['float32', 'users_per_second']
+    df_benchmark[f'precision@{K}_delta'] = df_benchmark[f'precision@{K}'] - df_benchmark.loc['float32', f'precision@{K}']
+    
+    return df_benchmark
@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+
 import numpy as np
 import pandas as pd
 
@@ -84,7 +88,8 @@ def prepare_result_lvl_2(data: pd.DataFrame,
                          feature_user_id: str = 'user_id',
                          feature_item_id: str = 'item_id',
                          feature_actual: str = 'actual',
-                         feature_predicted: str = 'predicted') -> pd.DataFrame:
+                         feature_predicted: str = 'predicted',
+                         candidates: pd.DataFrame = None) -> pd.DataFrame:
     
     '''
     Function for preparing result dataset with users' and items' ids for second level model.
@@ -99,8 +104,29 @@ def prepare_result_lvl_2(data: pd.DataFrame,
     feature_actual: str, contains feature name of actual bought items.
     
     feature_predicted: str, contains feature name of predicted items by first level model.
+    
+    candidates: pd.DataFrame, long format candidates (e.g. from recommenders.CandidateGenerator),
+        if given, it is used instead of 'feature_predicted' lists and all its columns are kept.
     '''
     
+    if candidates is not None:
+        # Пары пользователь-товар фактических покупок.
+        actual = (
+            data[[feature_user_id, feature_actual]]
+            .explode(feature_actual)
+            .dropna()
+            .rename(columns={feature_actual: feature_item_id})
+            .drop_duplicates()
+        )
+        actual[feature_item_id] = actual[feature_item_id].astype(candidates[feature_item_id].dtype)
+        actual[feature_actual] = 1
+        
+        result = candidates[candidates[feature_user_id].isin(data[feature_user_id])]
+        result = result.merge(actual, on=[feature_user_id, feature_item_id], how='left')
+        result[feature_actual] = result[feature_actual].fillna(0).astype(int)
+        
+        return result
+    
     result = data.copy()
     result = (
         result
@@ -120,3 +146,262 @@ def prepare_result_lvl_2(data: pd.DataFrame,
     result[feature_actual] = result[feature_actual].astype(int)
     
     return result
+
+
+def _hash_feature_spec(features: pd.DataFrame,
+                       feature_id: str,
+                       ids: np.ndarray,
+                       columns: list,
+                       identity: bool,
+                       vocabulary: 'dict | None') -> str:
+    
+    '''
+    Function for hashing feature matrix specification: parameters, ids' order, features' values and vocabulary.
+    '''
+    
+    spec = hashlib.sha1()
+    spec.update(json.dumps({'feature_id': feature_id, 'columns': list(columns), 'identity': identity}).encode())
+    spec.update(pd.util.hash_pandas_object(pd.Series(ids), index=False).values.tobytes())
+    spec.update(pd.util.hash_pandas_object(features[[feature_id] + list(columns)], index=False).values.tobytes())
+    
+    if vocabulary is not None:
+        spec.update(json.dumps(vocabulary, sort_keys=True).encode())
+    
+    return spec.hexdigest()
+
+
+def build_feature_matrix(features: pd.DataFrame,
+                         feature_id: str,
+                         ids: 'list | np.ndarray',
+                         columns: list,
+                         identity: bool = True,
+                         vocabulary: dict = None,
+                         cache_dir: str = None) -> 'scipy.sparse.csr_matrix & dict':
+    
+    '''
+    Function for building sparse one-hot feature matrix of users or items (e.g. for LightFM).
+    Rows of the matrix are aligned with 'ids' order, so 'ids' should be taken from recommender's index,
+    e.g. [model.id_to_userid[i] for i in range(len(model.id_to_userid))].
+    Ids absent from 'features' get only identity feature (or empty row).
+    
+    features : pd.DataFrame, dataset with users' or items' features (e.g. hh_demographic.csv, product.csv).
+    
+    feature_id : str, contains feature name of users' or items' ids.
+    
+    ids : list or np.ndarray of ids, order of matrix rows.
+    
+    columns : list of categorical feature names to encode.
+    
+    identity : bool, if True, identity block (one column per id) is added before categorical features.
+    
+    vocabulary : dict {'column=value': matrix column}, if given, it is reused as is
+        and values absent from it are ignored (e.g. vocabulary from train for test matrix).
+        If None, vocabulary is built from 'features'.
+    
+    cache_dir : str, directory for caching result as .npz keyed by hash of feature specification.
+        If None, result is not cached.
+    
+    Returns feature matrix (scipy.sparse.csr_matrix) and vocabulary.
+    '''
+    
+    # scipy импортируется только при построении матрицы, чтобы не замедлять импорт utils.
+    from scipy.sparse import csr_matrix, load_npz, save_npz
+    
+    ids = np.asarray(ids)
+    
+    if cache_dir is not None:
+        key = _hash_feature_spec(features, feature_id, ids, columns, identity, vocabulary)
+        path_matrix = os.path.join(cache_dir, f'features_{key}.npz')
+        path_vocabulary = os.path.join(cache_dir, f'features_{key}.json')
+        
+        if os.path.exists(path_matrix) and os.path.exists(path_vocabulary):
+            with open(path_vocabulary) as file:
+                return load_npz(path_matrix).tocsr(), json.load(file)
+    
+    data = features.drop_duplicates(subset=feature_id)
+    rows = pd.Index(ids).get_indexer(data[feature_id])
+    data = data[rows >= 0]
+    rows = rows[rows >= 0]
+    
+    list_tokens = []
+    list_rows = []
+    
+    # Единичный блок: собственный признак для каждого id.
+    if identity:
+        list_tokens.append(pd.Series(ids).astype(str).radd(f'{feature_id}=').values)
+        list_rows.append(np.arange(len(ids)))
+    
+    # Категориальные признаки: один столбец на каждое значение признака.
+    for column in columns:
+        values = data[column]
+        mask = values.notna().values
+        list_tokens.append(values[mask].astype(str).radd(f'{column}=').values)
+        list_rows.append(rows[mask])
+    
+    tokens = np.concatenate(list_tokens) if list_tokens else np.array([], dtype=object)
+    matrix_rows = np.concatenate(list_rows) if list_rows else np.array([], dtype=np.int64)
+    
+    if vocabulary is None:
+        vocabulary = {token: i for i, token in enumerate(pd.unique(tokens))}
+    
+    matrix_columns = pd.Series(tokens, dtype=object).map(vocabulary).values
+    mask = ~pd.isna(matrix_columns)
+    
+    matrix = csr_matrix((np.ones(mask.sum(), dtype=np.float32),
+                         (matrix_rows[mask], matrix_columns[mask].astype(np.int64))),
+                        shape=(len(ids), len(vocabulary)))
+    matrix.sum_duplicates()
+    
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_npz(path_matrix, matrix)
+        
+        with open(path_vocabulary, 'w') as file:
+            json.dump(vocabulary, file)
+    
+    return matrix, vocabulary
+
+
+def sample_negatives(data: pd.DataFrame,
+                     negative_ratio: float = 0.1,
+                     strategy: str = 'uniform',
+                     feature_user_id: str = 'user_id',
+                     feature_actual: str = 'actual',
+                     feature_rank: str = None,
+                     feature_weight: str = 'weight',
+                     random_state: int = None) -> pd.DataFrame:
+    
+    '''
+    Function for negative downsampling of second level model training dataset.
+    All positive rows (actual == 1) are kept, negative rows are sampled,
+    every kept row gets sampling weight 1 / probability, so weighted metrics stay calibrated.
+    
+    data : pd.DataFrame, dataset from prepare_result_lvl_2.
+    
+    negative_ratio : float, expected share of negative rows to keep.
+    
+    strategy : str, 'uniform' - every negative row is kept with equal probability,
+        'hard' - probability is proportional to 1 / rank of first level model,
+        so higher ranked (hard) negatives are kept more often.
+    
+    feature_user_id : str, contains feature name of users' ids.
+    
+    feature_actual : str, contains feature name of actual flag.
+    
+    feature_rank : str, contains feature name of first level rank,
+        if None - rank is an order of user's rows in 'data' (order of predicted items).
+        Rank 0 or missing rank means that the item is absent from this source (like 'rank_<source>'
+        of recommenders.CandidateGenerator), such rows get the lowest priority: rank = user's number of rows + 1.
+    
+    feature_weight : str, feature name for sampling weights.
+    
+    random_state : int, seed of random generator.
+    '''
+    
+    if strategy not in ('uniform', 'hard'):
+        raise Exception('Parametr "strategy" must be "uniform" or "hard"!')
+    
+    if not 0 < negative_ratio <= 1:
+        raise Exception('Parametr "negative_ratio" must be in (0, 1]!')
+    
+    negative = (data[feature_actual] == 0).values
+    probability = np.ones(len(data))
+    
+    if strategy == 'uniform':
+        probability[negative] = negative_ratio
+    else:
+        if feature_rank is None:
+            rank = data.groupby(by=feature_user_id, sort=False).cumcount().values + 1
+        else:
+            rank = data[feature_rank].values.astype(np.float64)
+            
+            # Товары, отсутствующие в источнике (ранг 0), получают ранг ниже всех кандидатов пользователя.
+            absent = ~(rank > 0)
+            rank[absent] = data.groupby(by=feature_user_id, sort=False)[feature_user_id].transform('size').values[absent] + 1
+        
+        # Вероятность обратно пропорциональна рангу и нормирована на ожидаемую долю отрицательных строк.
+        score = 1 / rank[negative]
+        probability[negative] = np.minimum(score * negative_ratio * negative.sum() / score.sum(), 1)
+    
+    rng = np.random.default_rng(random_state)
+    keep = rng.random(len(data)) < probability
+    
+    result = data[keep].copy()
+    result[feature_weight] = (1 / probability[keep]).astype(np.float32)
+    
+    return result
+
+
+def encode_categorical(data: pd.DataFrame,
+                       columns: list,
+                       categories: dict = None) -> 'pd.DataFrame & dict':
+    
+    '''
+    Function for encoding categorical features into integer codes (instead of strings) for second level model.
+    
+    data : pd.DataFrame, dataset to encode.
+    
+    columns : list of categorical feature names.
+    
+    categories : dict {column: categories}, if given (e.g. from train dataset), it is reused
+        and values absent from it get code -1. If None, categories are built from 'data'.
+    
+    Returns encoded dataset and categories.
+    '''
+    
+    result = data.copy()
+    categories = {} if categories is None else dict(categories)
+    
+    for column in columns:
+        if column not in categories:
+            categories[column] = pd.Index(result[column].dropna().unique())
+        
+        codes = categories[column].get_indexer(result[column])
+        result[column] = codes.astype(np.int32 if len(categories[column]) > np.iinfo(np.int16).max else np.int16)
+    
+    return result, categories
+
+
+def prepare_train_lvl_2(data: pd.DataFrame,
+                        cat_features: list,
+                        add_features=None,
+                        negative_ratio: float = 0.1,
+                        strategy: str = 'uniform',
+                        categories: dict = None,
+                        random_state: int = None,
+                        **kwargs) -> 'pd.DataFrame & dict':
+    
+    '''
+    Function for building compact training dataset of second level model:
+    negative downsampling (sample_negatives), adding features to the sampled rows only
+    and encoding categorical features into integer codes (encode_categorical).
+    
+    data : pd.DataFrame, dataset from prepare_result_lvl_2.
+    
+    cat_features : list of categorical feature names.
+    
+    add_features : function of pd.DataFrame returning pd.DataFrame with added features, if None - features are not added.
+    
+    negative_ratio, strategy, random_state, kwargs : parameters of sample_negatives.
+    
+    categories : dict, parameter of encode_categorical.
+    
+    Returns training dataset with sampling weights and categories.
+    
+    
+    Examples
+    --------
+    >>> X_train, categories = utils.prepare_train_lvl_2(X_train, cat_feats, add_features, negative_ratio=0.1, random_state=0)
+    >>> model_2.fit(X_train.drop(columns=['actual', 'weight']), X_train['actual'], sample_weight=X_train['weight'])
+    '''
+    
+    result = sample_negatives(data,
+                              negative_ratio=negative_ratio,
+                              strategy=strategy,
+                              random_state=random_state,
+                              **kwargs)
+    
+    if add_features is not None:
+        result = add_features(result)
+    
+    return encode_categorical(result, cat_features, categories)
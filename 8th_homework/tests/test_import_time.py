@@ -0,0 +1,32 @@
+import sys
+
+from pathlib import Path
+
+import pytest
+
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from src.backends import import_time
+from src.backends import is_loaded
+
+
+# Бюджет времени импорта модуля (без numpy и pandas) в секундах.
+IMPORT_BUDGET = 0.5
+
+
+@pytest.mark.parametrize('module', ['src.metrics', 'src.utils', 'src.cache'])
+def test_import_is_lightweight(module):
+    
+    elapsed, loaded = import_time(module, cwd=ROOT)
+    
+    assert not loaded, f'Import of {module} loads heavy modules: {loaded}!'
+    assert elapsed < IMPORT_BUDGET, f'Import of {module} takes {elapsed:.3f} s (budget {IMPORT_BUDGET} s)!'
+
+
+def test_recommenders_do_not_load_backends():
+    
+    from src import recommenders
+    
+    assert not any(is_loaded(name) for name in ('implicit.als', 'implicit.item_item', 'catboost', 'lightfm'))